@@ -0,0 +1,100 @@
+# A module which saves mission progress so that an interrupted mission can be resumed
+
+import hashlib
+import json
+import os
+import struct
+
+try:
+    from mavsdk.mission import MissionError
+except ImportError:
+    # mavsdk is only needed to talk to a drone, so the file handling works without it
+    MissionError = None
+
+
+CHECKPOINT_FILE = 'mission_checkpoint.json'  # where mission progress is saved for resuming
+
+
+def plan_fingerprint(mission_items: list) -> str:
+    """
+    Returns a hash identifying a list of mission items by their positions
+    Positions are quantized the way MAVLink sends them (int32 degE7 and float32 altitude)
+    so that a planned mission matches the same mission downloaded from the drone
+    """
+    points = [(round(i.latitude_deg * 1e7), round(i.longitude_deg * 1e7),
+               struct.unpack('f', struct.pack('f', i.relative_altitude_m))[0])
+              for i in mission_items]
+    return hashlib.sha1(json.dumps(points).encode()).hexdigest()
+
+
+def load_checkpoint(fingerprint: str, path=CHECKPOINT_FILE):
+    """
+    Returns the saved progress for the mission plan with this fingerprint, or None
+    """
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if checkpoint.get('plan') != fingerprint:
+        return None
+
+    return checkpoint
+
+
+def save_checkpoint(fingerprint: str, offset: int, current: int, total: int, path=CHECKPOINT_FILE):
+    """
+    Saves mission progress, writing to a temporary file first so a crash never leaves it half written
+    offset - the index in the full plan of the first item uploaded to the drone
+    current - the index in the full plan of the item the drone is working on
+    """
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'plan': fingerprint, 'offset': offset, 'current': current, 'total': total}, f)
+    os.replace(tmp_file, path)
+
+
+def record_progress(mission_progress, fingerprint: str, offset: int, path=CHECKPOINT_FILE) -> tuple:
+    """
+    Saves a progress report from the drone, which counts from the first uploaded item
+
+    returns (current, total) in terms of the full plan
+    """
+    current = mission_progress.current + offset
+    total = mission_progress.total + offset
+    save_checkpoint(fingerprint, offset, current, total, path)
+
+    return current, total
+
+
+async def prepare_mission(drone, mission_items: list, plan_factory, path=CHECKPOINT_FILE) -> int:
+    """
+    Gets the mission onto the drone, resuming from the last checkpoint if there is one
+    If the drone still holds the mission, only the current item is changed,
+    otherwise only the remaining waypoints are uploaded
+    plan_factory - builds the plan to upload from a list of mission items, i.e. MissionPlan
+
+    returns the index in the full plan of the first item uploaded to the drone
+    """
+    checkpoint = load_checkpoint(plan_fingerprint(mission_items), path)
+
+    if checkpoint is None or not 0 < checkpoint['current'] < len(mission_items):
+        await drone.mission.upload_mission(plan_factory(mission_items))
+        return 0
+
+    offset, current = checkpoint['offset'], checkpoint['current']
+
+    # check whether the drone still has the mission loaded
+    try:
+        loaded = await drone.mission.download_mission()
+        if plan_fingerprint(loaded.mission_items) == plan_fingerprint(mission_items[offset:]):
+            print(f"Resuming loaded mission at item {current}/{len(mission_items)}")
+            await drone.mission.set_current_mission_item(current - offset)
+            return offset
+    except MissionError as e:
+        print(f"Could not reuse the loaded mission: {e}")
+
+    print(f"Uploading remaining {len(mission_items) - current}/{len(mission_items)} mission items")
+    await drone.mission.upload_mission(plan_factory(mission_items[current:]))
+    return current
@@ -0,0 +1,178 @@
+# A module which converts captured hyperspectral cubes while the mission is still flying
+
+import asyncio
+import os
+import os.path as osp
+from concurrent.futures import ProcessPoolExecutor
+
+
+def convert_cube(hdrfilepath):
+    """
+    Converts a single .hdr cube to pngs and returns its path
+    Imported lazily so the pipeline can be used without spectral installed
+    """
+    from convert_hdr_to_pngs import convert_hdr_to_pngs
+    convert_hdr_to_pngs(hdrfilepath)
+    return hdrfilepath
+
+
+def find_cubes(directory):
+    """
+    Returns the sorted .hdr files in a directory whose binary file exists,
+    as (path, sizes) where sizes are the current sizes of the .hdr and binary files
+    The binary may still be being written, see IngestPipeline.scan
+    """
+    cubes = []
+    for name in sorted(os.listdir(directory)):
+        path = osp.join(directory, name)
+        binfile, ext = osp.splitext(path)
+        if ext == '.hdr' and osp.exists(binfile):
+            cubes.append((path, (osp.getsize(path), osp.getsize(binfile))))
+
+    return cubes
+
+
+class IngestPipeline():
+    """
+    Watches a drop directory for new cubes and converts them in a bounded worker pool
+    The queue is bounded, so scanning waits rather than piling up work when the workers fall behind
+    A cube is only queued once its files have stopped growing between two scans, interval seconds apart
+    A cube that fails to convert is scanned again, up to retries more times
+    """
+
+    def __init__(self, directory, workers=1, queue_size=4, interval=1.0, retries=2,
+                 convert=convert_cube, executor=None):
+        self.directory = directory
+        self.workers = workers
+        self.interval = interval
+        self.retries = retries
+        self.convert = convert
+        self.executor = executor
+        self.owns_executor = executor is None
+
+        self.queue = None
+        self.queue_size = queue_size
+        self.seen = set()
+        self.sizes = {}     # file sizes of unqueued cubes at the last scan
+        self.failures = {}  # (failed conversions, last error) of cubes waiting to be retried
+        self.results = []  # paths of converted cubes
+        self.errors = []   # (path, exception) for cubes that failed to convert
+        self.tasks = []
+
+
+    def start(self):
+        """
+        Starts the conversion workers on the running event loop
+        """
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        if self.owns_executor:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        self.tasks = [asyncio.ensure_future(self.worker()) for i in range(self.workers)]
+
+
+    async def scan(self):
+        """
+        Queues any cubes in the drop directory that have not been seen yet
+        and have not changed size since the last scan
+        """
+        cubes = find_cubes(self.directory)
+
+        # give up on cubes waiting to be retried whose files have gone
+        found = set(path for path, sizes in cubes)
+        for path in list(self.failures):
+            if path not in self.seen and path not in found:
+                self.give_up(path)
+
+        for path, sizes in cubes:
+            if path in self.seen:
+                continue
+
+            previous = self.sizes.get(path)
+            self.sizes[path] = sizes
+            if sizes != previous:
+                continue    # new or still being written, check again next scan
+
+            # only mark as seen once queued, so a cancelled put does not lose the cube
+            await self.queue.put(path)
+            self.seen.add(path)
+            del self.sizes[path]
+
+
+    async def watch(self):
+        """
+        Scans the drop directory every interval seconds until cancelled
+        """
+        while True:
+            await self.scan()
+            await asyncio.sleep(self.interval)
+
+
+    async def worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            path = await self.queue.get()
+            try:
+                self.results.append(await loop.run_in_executor(self.executor, self.convert, path))
+                self.failures.pop(path, None)
+            except Exception as e:
+                print(f"Failed to convert {path}: {e}")
+                count = self.failures.get(path, (0, None))[0] + 1
+                self.failures[path] = (count, e)
+                if count <= self.retries:
+                    self.seen.discard(path)     # picked up again by a later scan
+                else:
+                    self.give_up(path)
+            finally:
+                self.queue.task_done()
+
+
+    def give_up(self, path):
+        """
+        Stops retrying a failed cube and records its last error
+        """
+        count, error = self.failures.pop(path)
+        self.sizes.pop(path, None)
+        self.seen.add(path)
+        self.errors.append((path, error))
+
+
+    async def close(self):
+        """
+        Picks up any last cubes, waits for the queue to drain and stops the workers
+        Returns the paths of all converted cubes
+        """
+        # scan twice so that cubes dropped since the last scan are seen to be complete,
+        # and repeat while failed cubes are waiting to be retried
+        for attempt in range(self.retries + 1):
+            await self.scan()
+            await asyncio.sleep(self.interval)
+            await self.scan()
+            await self.queue.join()
+
+            if not self.failures:
+                break
+
+        # anything still waiting kept changing size, so stop retrying it
+        for path in list(self.failures):
+            self.give_up(path)
+
+        await self.stop()
+
+        return self.results
+
+
+    async def stop(self):
+        """
+        Stops the workers and shuts down the executor without waiting for queued cubes
+        """
+        for task in self.tasks:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+        # don't block the event loop, after close() there is nothing left running anyway
+        if self.owns_executor:
+            self.executor.shutdown(wait=False)
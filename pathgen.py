@@ -1,6 +1,28 @@
 # A module containing code that will return a set of points covering an arbitrary area
 
-from math import tan, cos, pi, degrees, radians
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from math import tan, cos, pi, degrees, radians, sqrt
+
+
+# https://stackoverflow.com/questions/25237356/convert-meters-to-decimal-degrees
+METERS_PER_DEGREE = 111.32 * 1000   # meters per degree of latitude, or of longitude at the equator
+
+
+def check_overlap(overlap: float):
+    """
+    Raises a ValueError unless overlap is a fraction in [0, 1), anything else would never finish decomposing
+    """
+    if not 0 <= overlap < 1:
+        raise ValueError(f"overlap must be at least 0 and less than 1, got {overlap}")
+
+
+def degrees_to_meters(delta: tuple, latitude: float) -> tuple:
+    """
+    Converts a (latitude, longitude) difference in decimal degrees into meters at the given latitude
+    """
+    return (delta[0] * METERS_PER_DEGREE, delta[1] * METERS_PER_DEGREE * cos(radians(latitude)))
 
 
 class Rectangle():
@@ -66,13 +88,17 @@ class Rectangle():
         """
         Returns true if the rectangle intersects or contains the polygon
         """
-        for i in range(len(polygon)):
-            j = i + 1
-            j = j % len(polygon)
-            intersects = self.intersects(polygon[i], polygon[j])
-            if intersects:
+        return self.overlaps_edges(polygon_edges(polygon))
+
+
+    def overlaps_edges(self, edges: list) -> bool:
+        """
+        Returns true if the rectangle intersects or contains any of the (a, b) edges
+        """
+        for a, b in edges:
+            if self.intersects(a, b):
                 return True
-        
+
         return False
 
 
@@ -94,20 +120,58 @@ class Rectangle():
 
 
 
+def polygon_edges(polygon: list) -> list:
+    """
+    Returns the closed list of (a, b) line segments making up a polygon
+    """
+    edges = []
+    for i in range(len(polygon)):
+        j = (i + 1) % len(polygon)
+        edges.append((polygon[i], polygon[j]))
+
+    return edges
+
+
+
+class Perimeter():
+    """
+    A class holding the geometry of a perimeter that does not depend on the photo size,
+    so that it can be shared between Workplaces planned over the same area
+    """
+    def __init__(self, points: list) -> None:
+        self.points = list(points)
+
+        # the centerpoint of the polygon
+        self.center = [0, 0]
+        for p in self.points:
+            self.center[0] += p[0]
+            self.center[1] += p[1]
+
+        self.center[0] = self.center[0] / len(self.points)
+        self.center[1] = self.center[1] / len(self.points)
+
+        self.edges = polygon_edges(self.points)
+
+
+
 class Workplace():
     """
     A class representing the Workplace to be used in workplace sampling for path generation
     Reference: https://core.ac.uk/download/pdf/74476273.pdf
     """
 
-    def __init__(self, start_pos: tuple, fov: tuple, altitude: float, perimeter: list):
+    def __init__(self, start_pos: tuple, fov: tuple, altitude: float, perimeter: list, overlap=0):
         """
         Segments the workplace grid based on the FOV and altitude the drone will fly at
         Uses Approximate Cellular Decomposition to do so
+        perimeter - a list of points or a preprocessed Perimeter
+        overlap - the fraction (0 to 1) by which neighboring photos overlap
         """
+        check_overlap(overlap)
         
         # get the width and height of the capture rectangles from fov in meters
-        size = self.photo_area_from_fov(fov, altitude, start_pos[1])
+        size = self.photo_area_from_fov(fov, altitude, start_pos[0])
+        size = (size[0] * (1 - overlap), size[1] * (1 - overlap))
 
         # decompose the area into a list of rectangles
         self.rectangles = self.flood_fill(size, perimeter)
@@ -125,21 +189,18 @@ class Workplace():
         Algorithm which fills a polygon with equally spaced, equally sized rectangles
         """
         
+        if not isinstance(perimeter, Perimeter):
+            perimeter = Perimeter(perimeter)
+
         # 1. Find the centerpoint of the polygon
-        center = [0, 0]
-        for p in perimeter:
-            center[0] += p[0]
-            center[1] += p[1]
-        
-        center[0] = center[0] / len(perimeter)
-        center[1] = center[1] / len(perimeter)
+        center = list(perimeter.center)
 
         # 2. initialize the center rectangle
         unspent = [Rectangle(center, size, (0, 0))]
         spent = []
 
         # handle case where initial rectangle already fully encompasses perimeter
-        if unspent[0].overlaps_polygon(perimeter):
+        if unspent[0].overlaps_edges(perimeter.edges):
             spent = [unspent[0]]
             unspent = []
 
@@ -164,7 +225,7 @@ class Workplace():
                         continue    # if the rect is on an occupied space, dont bother dealing with it
                     
                     # check to see if the rect is overlapping a polygon edge
-                    new_rect.border = new_rect.overlaps_polygon(perimeter)
+                    new_rect.border = new_rect.overlaps_edges(perimeter.edges)
 
                     # if the rect does not intersect but the rect that spawned it does, then this rect is outside the polygon
                     if (not new_rect.border) and rect.border:
@@ -359,15 +420,14 @@ class Workplace():
     def photo_area_from_fov(self, fov: tuple, altitude: float, latitude) -> tuple:
         """
         Takes the camera fov (degrees) and drone altitude (meters)
-        and returns the photo area coverage in decimal degrees
+        and returns the photo area coverage in decimal degrees of (latitude, longitude)
         """
         w = 2*altitude * tan(radians(fov[0]/2))
         h = 2*altitude * tan(radians(fov[1]/2))
 
-        # https://stackoverflow.com/questions/25237356/convert-meters-to-decimal-degrees
-        # convert meters to decimal degrees
-        w = w / (111.32 * 1000 * cos(radians(latitude)))
-        h = h / (111.32 * 1000 * cos(radians(latitude)))
+        # convert meters to decimal degrees, degrees of longitude shrink away from the equator
+        w = w / METERS_PER_DEGREE
+        h = h / (METERS_PER_DEGREE * cos(radians(latitude)))
         # print(f"Photo area (dd): ({w}, {h})")
 
         return (w, h)
@@ -413,4 +473,125 @@ class Workplace():
                     line += '|--|'
                 else:
                     line += f"({(grid[x][y]):02})"
-            print(line)
\ No newline at end of file
+            print(line)
+
+
+
+def build_workplace(start_pos: tuple, fov: tuple, altitude: float, perimeter: list, print_grid=False):
+    """
+    Builds a Workplace, optionally printing its potential field
+    Module level so that it can be sent to an executor
+    """
+    workplace = Workplace(start_pos=start_pos, fov=fov, altitude=altitude, perimeter=perimeter)
+
+    if print_grid:
+        workplace.print_grid(workplace.potential_field)
+
+    return workplace
+
+
+def build_workplace_to_pipe(connection, start_pos: tuple, fov: tuple, altitude: float, perimeter: list,
+                           print_grid=False):
+    """
+    Builds a Workplace and sends (workplace, None), or (None, error) if planning failed, down a pipe
+    Used as the target of the planning process in plan_async
+    """
+    try:
+        connection.send((build_workplace(start_pos, fov, altitude, perimeter, print_grid), None))
+    except Exception as e:
+        connection.send((None, e))
+    finally:
+        connection.close()
+
+
+async def plan_async(start_pos: tuple, fov: tuple, altitude: float, perimeter: list,
+                     print_grid=False, timeout=None):
+    """
+    Builds a Workplace in its own process so the event loop stays responsive while planning
+    Raises asyncio.TimeoutError if planning takes longer than timeout (seconds)
+    On timeout or cancellation the planning process is terminated
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=build_workplace_to_pipe, args=(sender, start_pos, fov, altitude, perimeter, print_grid))
+    process.start()
+
+    # only the planning process writes to the pipe, so the receiver sees EOF if it dies
+    sender.close()
+
+    loop = asyncio.get_event_loop()
+    try:
+        workplace, error = await asyncio.wait_for(loop.run_in_executor(None, receiver.recv), timeout)
+    except EOFError:
+        process.join()
+        raise RuntimeError(f"Planning process exited with code {process.exitcode} without a result")
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+    receiver.close()
+    if error is not None:
+        raise error
+
+    return workplace
+
+
+
+def evaluate_plan(start_pos: tuple, perimeter: Perimeter, altitude: float, fov: tuple, overlap: float,
+                  speed: float, photo_time: float) -> dict:
+    """
+    Plans a single (altitude, fov, overlap) combination and summarizes its cost
+    Module level so that it can be sent to an executor
+    """
+    workplace = Workplace(start_pos=start_pos, fov=fov, altitude=altitude, perimeter=perimeter, overlap=overlap)
+
+    path_length = 0
+    for a, b in zip(workplace.path, workplace.path[1:]):
+        dx, dy = degrees_to_meters((b.center[0] - a.center[0], b.center[1] - a.center[1]), start_pos[0])
+        path_length += sqrt(pow(dx, 2) + pow(dy, 2))
+
+    photo_size = (2*altitude * tan(radians(fov[0]/2)), 2*altitude * tan(radians(fov[1]/2)))
+
+    return {
+        'altitude': altitude,
+        'fov': fov,
+        'overlap': overlap,
+        'photo_size': photo_size,  # ground footprint of one photo (m)
+        'cell_size': degrees_to_meters(workplace.rectangles[0].size, start_pos[0]),  # spacing of the laid out cells (m)
+        'cells': len(workplace.rectangles),
+        'path_length': path_length,  # meters
+        'mission_items': len(workplace.path),
+        'flight_time': path_length / speed + len(workplace.path) * photo_time,  # seconds
+    }
+
+
+def sweep(start_pos: tuple, perimeter: list, configs: list, speed=1, photo_time=2, executor=None) -> list:
+    """
+    Evaluates many (altitude, fov, overlap) combinations over the same perimeter in parallel
+    The perimeter geometry is preprocessed once and shared between all of the runs
+    speed - the drone speed (m/s) used to estimate flight time
+    photo_time - the time (s) spent stopping to take each photo
+
+    returns one row per config, in the same order, see evaluate_plan for the columns
+    """
+    # check every config up front rather than finding a bad one after the rest have been planned
+    for altitude, fov, overlap in configs:
+        check_overlap(overlap)
+
+    if not isinstance(perimeter, Perimeter):
+        perimeter = Perimeter(perimeter)
+
+    owns_executor = executor is None
+    if owns_executor:
+        executor = ProcessPoolExecutor()
+
+    try:
+        futures = [
+            executor.submit(evaluate_plan, start_pos, perimeter, altitude, fov, overlap, speed, photo_time)
+            for altitude, fov, overlap in configs
+        ]
+        return [future.result() for future in futures]
+    finally:
+        if owns_executor:
+            executor.shutdown()
@@ -1,12 +1,18 @@
 # A script which simulates a drone following a path planned by the pathgen
 
 import asyncio
+import os
 from mavsdk import System
 from mavsdk.mission import (MissionItem, MissionPlan)
 
+import checkpoint
+import ingest
 import pathgen
 
 
+PLANNING_TIMEOUT = 300  # seconds to wait for the path planner before giving up
+CAPTURE_DIR = 'data/captures'  # directory the camera drops .hdr cubes into
+
 
 async def connect(drone: System):
     '''
@@ -57,56 +63,85 @@ async def run():
     print('running')
     drone = System()
 
-    # connect to the drone and wait for gps fix
-    await connect(drone)
-
-    # get the drone's starting position
-    async for position in drone.telemetry.position():
-        start_pos = (position.latitude_deg, position.longitude_deg)
-        print(f"Drone position is ({start_pos[0]}, {start_pos[1]})")
-        break
-
-    print_mission_progress_task = asyncio.ensure_future(
-        print_mission_progress(drone))
-
-    running_tasks = [print_mission_progress_task]
-    termination_task = asyncio.ensure_future(
-        observe_is_in_air(drone, running_tasks))
-
     # segment the workspace to get points for the mission
     perimeter = [
         (37.76966, -119.60218), (37.77075, -119.59952),
         (37.77025, -119.59359), (37.76803, -119.59862),
         (37.76768, -119.59536), (37.76559, -119.59900)
     ]
-    workplace = pathgen.Workplace(
+
+    # plan off the event loop so it overlaps with connecting to the drone
+    planning_task = asyncio.ensure_future(pathgen.plan_async(
         start_pos=(43.679782271987395, -70.2692889874136), 
         fov=(62.2, 48.8),   # the rpi cam 2 FOV 
         altitude=10, 
-        perimeter=perimeter
-    )
+        perimeter=perimeter,
+        print_grid=True,
+        timeout=PLANNING_TIMEOUT
+    ))
+
+    try:
+        # connect to the drone and wait for gps fix
+        await connect(drone)
+
+        # get the drone's starting position
+        async for position in drone.telemetry.position():
+            start_pos = (position.latitude_deg, position.longitude_deg)
+            print(f"Drone position is ({start_pos[0]}, {start_pos[1]})")
+            break
+
+        # wait for the path if planning is still running, before starting anything that would need cleaning up
+        workplace = await planning_task
+    except BaseException:
+        # stop the planning process, waiting so it is terminated before the loop stops
+        planning_task.cancel()
+        await asyncio.gather(planning_task, return_exceptions=True)
+        raise
+
+    # convert cubes as they are captured rather than after landing
+    os.makedirs(CAPTURE_DIR, exist_ok=True)
+    pipeline = ingest.IngestPipeline(CAPTURE_DIR)
+    pipeline.start()
+    watch_task = asyncio.ensure_future(pipeline.watch())
+
+    running_tasks = [watch_task]
+    termination_task = asyncio.ensure_future(
+        observe_is_in_air(drone, running_tasks))
+
+    try:
+        # build the mission
+        mission_plan = mission_from_rectangles(
+            rectangles=workplace.path,
+            altitude=10,
+            speed=1
+        )
 
-    workplace.print_grid(workplace.potential_field)
+        await drone.mission.set_return_to_launch_after_mission(True)
 
-    # build the mission
-    mission_plan = mission_from_rectangles(
-        rectangles=workplace.path,
-        altitude=10,
-        speed=1
-    )
+        # upload the mission, or resume it if a previous run was interrupted
+        offset = await checkpoint.prepare_mission(drone, mission_plan.mission_items, MissionPlan)
 
-    await drone.mission.set_return_to_launch_after_mission(True)
+        print_mission_progress_task = asyncio.ensure_future(
+            print_mission_progress(drone, checkpoint.plan_fingerprint(mission_plan.mission_items), offset))
+        running_tasks.append(print_mission_progress_task)
 
-    # upload the mission
-    await drone.mission.upload_mission(mission_plan)
+        print("arming!")
+        await drone.action.arm()
 
-    print("arming!")
-    await drone.action.arm()
+        print("starting mission")
+        await drone.mission.start_mission()
 
-    print("starting mission")
-    await drone.mission.start_mission()
+        await termination_task
 
-    await termination_task
+        converted = await pipeline.close()
+        print(f"Converted {len(converted)} cubes")
+    finally:
+        # if anything failed before landing, stop the monitoring tasks and the conversion workers
+        termination_task.cancel()
+        for task in running_tasks:
+            task.cancel()
+        await asyncio.gather(termination_task, *running_tasks, return_exceptions=True)
+        await pipeline.stop()
 
     print("Mission complete.")
 
@@ -134,11 +169,14 @@ async def observe_is_in_air(drone, running_tasks):
             return
 
 
-async def print_mission_progress(drone):
+async def print_mission_progress(drone, fingerprint, offset=0):
+    """ Prints mission progress and checkpoints it so an interrupted
+    mission can be resumed. offset is the index of the first uploaded item """
     async for mission_progress in drone.mission.mission_progress():
+        current, total = checkpoint.record_progress(mission_progress, fingerprint, offset)
         print(f"Mission progress: "
-              f"{mission_progress.current}/"
-              f"{mission_progress.total}")
+              f"{current}/"
+              f"{total}")
 
 
 if __name__ == "__main__":
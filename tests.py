@@ -1,5 +1,29 @@
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import threading
 import unittest
-from pathgen import Rectangle, Workplace
+from types import SimpleNamespace
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from ingest import IngestPipeline
+import checkpoint
+from math import asin, cos, radians, sin, sqrt
+from pathgen import Rectangle, Workplace, plan_async, sweep
+
+
+# test field over payson park
+PAYSON_PARK = [(43.679882271987395, -70.2693889874136), (43.68162231019378, -70.27141117491476),
+        (43.68288076964761, -70.2725732966138), (43.68418710100531, -70.27068259077888),
+        (43.68382568551194, -70.27015271143725), (43.684021633941214, -70.26986970769798),
+        (43.68328573541723, -70.26871360731622), (43.6834468500671, -70.26843662493309),
+        (43.68068606893511, -70.26390254378708), (43.68106927643034, -70.263511155637),
+        (43.680760097846516, -70.26292106273382), (43.67989351836035, -70.26378813802968),
+        (43.679122731145114, -70.26230086305941), (43.67906176450213, -70.26235505526479),
+        (43.67959304316595, -70.2647214482337), (43.679366597097584, -70.26614850964243),
+        (43.67896160488272, -70.26780438258504)]
+PAYSON_PARK_START = (43.679782271987395, -70.2692889874136)
 
 
 class TestRectangle(unittest.TestCase):
@@ -28,26 +52,345 @@ class TestWorkPlace(unittest.TestCase):
 
     def test_flood_fill(self):
         # test floodfill over payson park
-        perimeter = [(43.679882271987395, -70.2693889874136), (43.68162231019378, -70.27141117491476),
-                (43.68288076964761, -70.2725732966138), (43.68418710100531, -70.27068259077888),
-                (43.68382568551194, -70.27015271143725), (43.684021633941214, -70.26986970769798),
-                (43.68328573541723, -70.26871360731622), (43.6834468500671, -70.26843662493309),
-                (43.68068606893511, -70.26390254378708), (43.68106927643034, -70.263511155637),
-                (43.680760097846516, -70.26292106273382), (43.67989351836035, -70.26378813802968),
-                (43.679122731145114, -70.26230086305941), (43.67906176450213, -70.26235505526479),
-                (43.67959304316595, -70.2647214482337), (43.679366597097584, -70.26614850964243), 
-                (43.67896160488272, -70.26780438258504)]
         workplace = Workplace(
-            start_pos=(43.679782271987395, -70.2692889874136), 
+            start_pos=PAYSON_PARK_START, 
             fov=(62.2, 48.8),   # the rpi cam 2 FOV 
             altitude=20.5, 
-            perimeter=perimeter
+            perimeter=PAYSON_PARK
         )
 
         #rects = workplace.flood_fill((0.0001, 0.0001), perimeter)
         #for r in rects:
         #    print(r)
 
+    def test_plan_async(self):
+        workplace = asyncio.run(plan_async(PAYSON_PARK_START, (62.2, 48.8), 20, PAYSON_PARK))
+        expected = Workplace(PAYSON_PARK_START, (62.2, 48.8), 20, PAYSON_PARK)
+
+        self.assertEqual([r.index for r in workplace.path], [r.index for r in expected.path])
+
+    def test_plan_async_timeout(self):
+        # a low altitude gives thousands of cells, which takes over a second to plan
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(plan_async(PAYSON_PARK_START, (62.2, 48.8), 10, PAYSON_PARK, timeout=0.1))
+
+        # the worker is terminated rather than left to finish the plan
+        for process in multiprocessing.active_children():
+            process.join(timeout=1)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_plan_async_error(self):
+        # errors in the planning process are raised by plan_async
+        with self.assertRaises(ZeroDivisionError):
+            asyncio.run(plan_async((43.6798, -70.2693), (62.2, 48.8), 20, []))
+
+    def test_sweep(self):
+        configs = [(20, (62.2, 48.8), 0), (30, (62.2, 48.8), 0), (30, (62.2, 48.8), 0.2)]
+
+        rows = sweep(PAYSON_PARK_START, PAYSON_PARK, configs)
+
+        self.assertEqual([(r['altitude'], r['overlap']) for r in rows], [(20, 0), (30, 0), (30, 0.2)])
+
+        expected = Workplace(PAYSON_PARK_START, (62.2, 48.8), 20, PAYSON_PARK)
+        self.assertEqual(rows[0]['mission_items'], len(expected.path))
+
+        # flying higher covers more ground per photo, overlapping photos needs more of them
+        self.assertGreater(rows[0]['cells'], rows[1]['cells'])
+        self.assertLess(rows[1]['cells'], rows[2]['cells'])
+
+        # overlapping photos are laid out closer together than their footprint
+        self.assertAlmostEqual(rows[2]['cell_size'][0], rows[2]['photo_size'][0] * 0.8)
+        self.assertAlmostEqual(rows[2]['cell_size'][1], rows[2]['photo_size'][1] * 0.8)
+
+    def test_sweep_path_length(self):
+        row, = sweep(PAYSON_PARK_START, PAYSON_PARK, [(20, (62.2, 48.8), 0)])
+        path = Workplace(PAYSON_PARK_START, (62.2, 48.8), 20, PAYSON_PARK).path
+
+        # measure the same path with the haversine formula
+        expected = 0
+        for a, b in zip(path, path[1:]):
+            lat_a, lon_a, lat_b, lon_b = map(radians, (*a.center, *b.center))
+            h = sin((lat_b - lat_a) / 2) ** 2 + cos(lat_a) * cos(lat_b) * sin((lon_b - lon_a) / 2) ** 2
+            expected += 2 * 6371000 * asin(sqrt(h))
+
+        self.assertAlmostEqual(row['path_length'], expected, delta=expected * 0.005)
+        self.assertAlmostEqual(row['flight_time'], row['path_length'] + row['mission_items'] * 2)
+
+    def test_invalid_overlap(self):
+        for overlap in [1, 1.5, -0.1]:
+            with self.assertRaises(ValueError):
+                Workplace(PAYSON_PARK_START, (62.2, 48.8), 20, PAYSON_PARK, overlap=overlap)
+
+        with self.assertRaises(ValueError):
+            sweep(PAYSON_PARK_START, PAYSON_PARK, [(20, (62.2, 48.8), 0), (20, (62.2, 48.8), 1)])
+
+
+
+class TestIngestPipeline(unittest.TestCase):
+
+    def test_converts_dropped_cubes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ['a.hdr', 'a', 'b.hdr', 'b', 'partial.hdr']:
+                open(os.path.join(directory, name), 'w').close()
+
+            async def run():
+                pipeline = IngestPipeline(directory, workers=2, queue_size=1, interval=0.01,
+                                          convert=lambda path: path, executor=ThreadPoolExecutor(2))
+                pipeline.start()
+                await pipeline.scan()
+                open(os.path.join(directory, 'c.hdr'), 'w').close()
+                open(os.path.join(directory, 'c'), 'w').close()
+                return await pipeline.close()
+
+            converted = asyncio.run(run())
+
+        # partial.hdr has no binary file yet so it is skipped
+        self.assertEqual(sorted(os.path.basename(p) for p in converted), ['a.hdr', 'b.hdr', 'c.hdr'])
+
+    def test_cancelled_watch_keeps_cubes(self):
+        names = ['a', 'b', 'c', 'd', 'e', 'f']
+        with tempfile.TemporaryDirectory() as directory:
+            for name in names:
+                open(os.path.join(directory, name + '.hdr'), 'w').close()
+                open(os.path.join(directory, name), 'w').close()
+
+            release = threading.Event()
+
+            def convert(path):
+                release.wait()
+                return path
+
+            async def run():
+                pipeline = IngestPipeline(directory, workers=1, queue_size=1, interval=0.01,
+                                          convert=convert, executor=ThreadPoolExecutor(1))
+                pipeline.start()
+                watch_task = asyncio.ensure_future(pipeline.watch())
+
+                # one cube converting, one queued and the watcher blocked putting the next
+                await asyncio.sleep(0.2)
+                watch_task.cancel()
+                try:
+                    await watch_task
+                except asyncio.CancelledError:
+                    pass
+
+                release.set()
+                return await pipeline.close()
+
+            converted = asyncio.run(run())
+
+        self.assertEqual(sorted(os.path.basename(p) for p in converted), [n + '.hdr' for n in names])
+
+    def test_waits_for_binary_to_be_written(self):
+        with tempfile.TemporaryDirectory() as directory:
+            hdrfile = os.path.join(directory, 'a.hdr')
+            binfile = os.path.join(directory, 'a')
+            open(hdrfile, 'w').close()
+            with open(binfile, 'wb') as f:
+                f.write(b'0' * 10)
+
+            async def run():
+                # convert records how much of the binary had been written
+                pipeline = IngestPipeline(directory, interval=0.01,
+                                          convert=lambda path: os.path.getsize(binfile),
+                                          executor=ThreadPoolExecutor(1))
+                pipeline.start()
+                await pipeline.scan()
+                with open(binfile, 'ab') as f:
+                    f.write(b'0' * 10)
+
+                # the binary grew since the last scan so it is not queued yet
+                await pipeline.scan()
+                self.assertEqual(pipeline.seen, set())
+
+                return await pipeline.close()
+
+            converted = asyncio.run(run())
+
+        self.assertEqual(converted, [20])
+
+    def test_retries_failed_cubes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ['a.hdr', 'a', 'bad.hdr', 'bad']:
+                open(os.path.join(directory, name), 'w').close()
+
+            attempts = []
+
+            def convert(path):
+                attempts.append(os.path.basename(path))
+                # a.hdr fails once, bad.hdr always fails
+                if path.endswith('bad.hdr') or attempts.count('a.hdr') == 1:
+                    raise ValueError('truncated cube')
+                return path
+
+            async def run():
+                pipeline = IngestPipeline(directory, retries=1, interval=0.01,
+                                          convert=convert, executor=ThreadPoolExecutor(1))
+                pipeline.start()
+                converted = await pipeline.close()
+                return converted, pipeline.errors
+
+            converted, errors = asyncio.run(run())
+
+        self.assertEqual([os.path.basename(p) for p in converted], ['a.hdr'])
+        self.assertEqual([os.path.basename(p) for p, e in errors], ['bad.hdr'])
+        self.assertEqual(attempts.count('bad.hdr'), 2)
+
+    def test_gives_up_on_removed_cubes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ['a.hdr', 'a']:
+                open(os.path.join(directory, name), 'w').close()
+
+            def convert(path):
+                # fail and remove the cube, so it can never be scanned again for a retry
+                os.remove(path)
+                os.remove(path[:-len('.hdr')])
+                raise ValueError('truncated cube')
+
+            async def run():
+                pipeline = IngestPipeline(directory, retries=2, interval=0.01,
+                                          convert=convert, executor=ThreadPoolExecutor(1))
+                pipeline.start()
+                converted = await asyncio.wait_for(pipeline.close(), 3)
+                return converted, pipeline.errors
+
+            converted, errors = asyncio.run(run())
+
+        self.assertEqual(converted, [])
+        self.assertEqual([os.path.basename(p) for p, e in errors], ['a.hdr'])
+
+
+
+class FakeMissionError(Exception):
+    pass
+
+
+class FakePlan():
+    def __init__(self, mission_items):
+        self.mission_items = mission_items
+
+
+class FakeMission():
+    """
+    Stands in for drone.mission, holding whatever mission was last uploaded
+    """
+    def __init__(self, loaded=None):
+        self.loaded = loaded
+        self.uploads = []
+        self.current = None
+
+    async def upload_mission(self, plan):
+        self.uploads.append(plan)
+        self.loaded = plan
+
+    async def download_mission(self):
+        if self.loaded is None:
+            raise FakeMissionError('no mission')
+
+        # positions come back at MAVLink precision
+        return FakePlan([SimpleNamespace(latitude_deg=round(i.latitude_deg * 1e7) / 1e7,
+                                         longitude_deg=round(i.longitude_deg * 1e7) / 1e7,
+                                         relative_altitude_m=i.relative_altitude_m)
+                         for i in self.loaded.mission_items])
+
+    async def set_current_mission_item(self, index):
+        self.current = index
+
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'checkpoint.json')
+        self.plan = FakePlan([SimpleNamespace(latitude_deg=43.68 + i * 1.23456789e-5, longitude_deg=-70.27,
+                                              relative_altitude_m=10.1) for i in range(10)])
+        self.fingerprint = checkpoint.plan_fingerprint(self.plan.mission_items)
+
+        # stands in for mavsdk's MissionError, which is not needed to run the tests
+        patcher = mock.patch.object(checkpoint, 'MissionError', FakeMissionError)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def prepare(self, mission):
+        return asyncio.run(checkpoint.prepare_mission(
+            SimpleNamespace(mission=mission), self.plan.mission_items, FakePlan, self.path))
+
+    def uploaded(self, mission):
+        return [plan.mission_items for plan in mission.uploads]
+
+    def progress(self, current, total, offset):
+        return checkpoint.record_progress(SimpleNamespace(current=current, total=total),
+                                          self.fingerprint, offset, self.path)
+
+    def test_fingerprint_matches_downloaded_mission(self):
+        mission = FakeMission(self.plan)
+        loaded = asyncio.run(mission.download_mission())
+        self.assertEqual(checkpoint.plan_fingerprint(loaded.mission_items), self.fingerprint)
+
+        # a position just past half of the sixth decimal rounds differently once sent over MAVLink
+        plan = FakePlan([SimpleNamespace(latitude_deg=43.68000050001, longitude_deg=-70.27, relative_altitude_m=10.1)])
+        loaded = asyncio.run(FakeMission(plan).download_mission())
+        self.assertEqual(checkpoint.plan_fingerprint(loaded.mission_items),
+                         checkpoint.plan_fingerprint(plan.mission_items))
+
+    def test_no_checkpoint_uploads_everything(self):
+        mission = FakeMission()
+        self.assertEqual(self.prepare(mission), 0)
+        self.assertEqual(self.uploaded(mission), [self.plan.mission_items])
+
+    def test_resume_loaded_mission(self):
+        self.progress(4, 10, 0)
+
+        mission = FakeMission(self.plan)
+        self.assertEqual(self.prepare(mission), 0)
+        self.assertEqual(mission.uploads, [])
+        self.assertEqual(mission.current, 4)
+
+    def test_resume_after_suffix_upload(self):
+        self.progress(4, 10, 0)
+
+        # the drone lost the mission, so only the remainder is uploaded
+        mission = FakeMission()
+        self.assertEqual(self.prepare(mission), 4)
+        self.assertEqual(self.uploaded(mission), [self.plan.mission_items[4:]])
+
+        # progress on the suffix is reported relative to it
+        self.assertEqual(self.progress(2, 6, 4), (6, 10))
+
+        # interrupted again with the suffix still loaded
+        self.assertEqual(self.prepare(mission), 4)
+        self.assertEqual(len(mission.uploads), 1)
+        self.assertEqual(mission.current, 2)
+
+        # and again after the drone lost it
+        mission = FakeMission()
+        self.assertEqual(self.prepare(mission), 6)
+        self.assertEqual(self.uploaded(mission), [self.plan.mission_items[6:]])
+
+    def test_other_mission_loaded(self):
+        self.progress(4, 10, 0)
+
+        mission = FakeMission(FakePlan(self.plan.mission_items[:3]))
+        self.assertEqual(self.prepare(mission), 4)
+        self.assertEqual(self.uploaded(mission), [self.plan.mission_items[4:]])
+
+    def test_stale_checkpoint(self):
+        # a finished mission starts again from the beginning
+        self.progress(10, 10, 0)
+        mission = FakeMission(self.plan)
+        self.assertEqual(self.prepare(mission), 0)
+        self.assertEqual(self.uploaded(mission), [self.plan.mission_items])
+
+        # as does a checkpoint from a different plan
+        checkpoint.save_checkpoint('another plan', 0, 4, 10, self.path)
+        mission = FakeMission(self.plan)
+        self.assertEqual(self.prepare(mission), 0)
+        self.assertEqual(self.uploaded(mission), [self.plan.mission_items])
+
 
 
 if __name__ == "__main__":